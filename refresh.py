@@ -1,11 +1,25 @@
 import subprocess
+import shlex
 from pathlib import Path
 from datetime import datetime
+import io
 import json
+import re
 import fnmatch
+import functools
 import hashlib
+import collections
+import contextlib
+import shutil
+import stat
+import struct
+import tarfile
+import time
 import pyzipper
 import zipfile
+import zlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
@@ -21,6 +35,13 @@ def style_panel(title, text, color="cyan"):
     return Panel(text, title=title, style=color, expand=True)
 
 
+def plain_print(*objects, **kwargs):
+    # --silent: skip rich's render pipeline and drop panels and tables
+    text = [obj for obj in objects if isinstance(obj, str)]
+    if text:
+        print(*text)
+
+
 # ----------------- Config -----------------
 CONFIG = {
     "exclude_from_backup": ["backup"],
@@ -28,9 +49,18 @@ CONFIG = {
     "hooks": {"pre_update": [], "post_update": []},
     "dry_run": False,
     "backup_password": None,
+    "backup_source": "worktree",
 }
 
-REQUIRED_KEYS = list(CONFIG.keys())
+# Keys with a default that older config files do not have to set
+OPTIONAL_KEYS = ["backup_source"]
+REQUIRED_KEYS = [key for key in CONFIG if key not in OPTIONAL_KEYS]
+
+BACKUP_WORKERS = os.cpu_count() or 4
+# At most this many compressed files wait in memory to be written
+BACKUP_WINDOW = 2 * BACKUP_WORKERS
+# Bigger files are streamed into the zip instead of compressed in one piece
+BACKUP_STREAM_SIZE = 64 * 1024 * 1024
 
 
 def load_config():
@@ -46,15 +76,17 @@ def load_config():
             console.print(f"[ERROR] Failed to load config: {e}")
     else:
         console.print("[WARN] No config found, using default values")
+    compile_excludes()
 
 
 def validate_config(cfg):
     for key in REQUIRED_KEYS:
         if key not in cfg:
             console.print(f"[ERROR] Missing config key '{key}'")
+    known_keys = REQUIRED_KEYS + OPTIONAL_KEYS
     for key in cfg.keys():
-        if key not in REQUIRED_KEYS:
-            suggestion = get_close_matches(key, REQUIRED_KEYS, n=1)
+        if key not in known_keys:
+            suggestion = get_close_matches(key, known_keys, n=1)
             if suggestion:
                 console.print(
                     f"[WARN] Unknown config key '{key}'. Did you mean '{suggestion[0]}'?"
@@ -64,58 +96,97 @@ def validate_config(cfg):
 
 
 # ----------------- Commands -----------------
-def run_command(cmd, capture=False):
+def run_command(cmd, capture=False, shell=False):
+    if isinstance(cmd, str) and not shell:
+        cmd = shlex.split(cmd)
+    display = cmd if isinstance(cmd, str) else shlex.join(cmd)
     if CONFIG.get("dry_run"):
-        console.print(f"[DRY-RUN] {cmd}")
+        console.print(f"[DRY-RUN] {display}")
+        return None
+    try:
+        result = subprocess.run(cmd, shell=shell, capture_output=True, text=True)
+    except FileNotFoundError:
+        console.print(f"[ERROR] Command not found: {display}")
         return None
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
     if result.returncode != 0:
-        console.print(f"[ERROR] Command failed: {cmd}\n{result.stderr.strip()}")
+        console.print(f"[ERROR] Command failed: {display}\n{result.stderr.strip()}")
         return None
     return result.stdout.strip() if capture else ""
 
 
 # ----------------- Git -----------------
-def ensure_gitignore():
+@functools.lru_cache(maxsize=1)
+def gitignore_lines():
     gitignore = Path(".gitignore")
-    existing = gitignore.read_text().splitlines() if gitignore.exists() else []
-    with gitignore.open("a") as f:
-        for pf in CONFIG["protected_files"]:
-            if pf not in existing:
-                f.write(f"{pf}\n")
-                console.print(f"'{pf}' added to .gitignore.")
+    if not gitignore.exists():
+        return frozenset()
+    return frozenset(gitignore.read_text().splitlines())
+
+
+def ensure_gitignore():
+    existing = gitignore_lines()
+    missing = [pf for pf in CONFIG["protected_files"] if pf not in existing]
+    if not missing:
+        return
+    with Path(".gitignore").open("a") as f:
+        f.write("\n".join(missing) + "\n")
+    gitignore_lines.cache_clear()
+    console.print(f"{', '.join(f"'{pf}'" for pf in missing)} added to .gitignore.")
 
 
 def sensitive_file_check():
-    gitignore = (
-        Path(".gitignore").read_text().splitlines()
-        if Path(".gitignore").exists()
-        else []
-    )
+    existing = gitignore_lines()
     for pf in CONFIG["protected_files"]:
-        if pf not in gitignore:
+        if pf not in existing:
             console.print(f"[WARN] Sensitive file {pf} not in .gitignore!")
 
 
+_GIT_CACHE = {}
+
+
+def remote_refs():
+    # One for-each-ref call answers both the default-branch and the
+    # branch-list lookups; the symref column marks origin/HEAD.
+    if "remote_refs" not in _GIT_CACHE:
+        output = run_command(
+            ["git", "for-each-ref", "--format=%(refname)%00%(symref)", "refs/remotes"],
+            capture=True,
+        )
+        refs = {}
+        for line in (output or "").splitlines():
+            refname, _, symref = line.partition("\0")
+            refs[refname.removeprefix("refs/remotes/")] = symref
+        _GIT_CACHE["remote_refs"] = refs
+    return _GIT_CACHE["remote_refs"]
+
+
 def get_default_branch():
-    branch_info = run_command("git remote show origin", capture=True)
-    if branch_info:
-        for line in branch_info.splitlines():
-            if "HEAD branch:" in line:
-                return line.split(":")[1].strip()
-    return run_command("git rev-parse --abbrev-ref HEAD", capture=True) or "main"
+    if "default_branch" not in _GIT_CACHE:
+        head = remote_refs().get("origin/HEAD")
+        if head:
+            branch = head.removeprefix("refs/remotes/origin/")
+        else:
+            branch = (
+                run_command(["git", "rev-parse", "--abbrev-ref", "HEAD"], capture=True)
+                or "main"
+            )
+        _GIT_CACHE["default_branch"] = branch
+    return _GIT_CACHE["default_branch"]
 
 
 def refresh_repo(branch):
     console.print(style_panel("Repo Update", f"Updating branch '{branch}'", "magenta"))
-    run_command("git fetch --all")
-    run_command(f"git reset --hard origin/{branch}")
-    run_command(f"git pull origin {branch}")
-    run_command("git gc")
+    run_command(["git", "fetch", "--all"])
+    run_command(["git", "reset", "--hard", f"origin/{branch}"])
+    run_command(["git", "pull", "origin", branch])
+    run_command(["git", "gc"])
+    _GIT_CACHE.clear()
 
 
 def repo_status():
-    commits = run_command("git log -10 --pretty=format:'%h|%an|%s'", capture=True)
+    commits = run_command(
+        ["git", "log", "-10", "--pretty=format:%h%x00%an%x00%s"], capture=True
+    )
     if not commits:
         console.print("[WARN] No commits found")
         return
@@ -129,7 +200,7 @@ def repo_status():
 
     for line in commits.splitlines():
         try:
-            commit_hash, author, message = line.split("|", 2)
+            commit_hash, author, message = line.split("\0", 2)
             table.add_row(commit_hash, author, message)
         except ValueError:
             continue
@@ -139,11 +210,281 @@ def repo_status():
 
 
 # ----------------- Backup -----------------
+def compile_excludes():
+    global EXCLUDE_RE
+    patterns = [*CONFIG["exclude_from_backup"], ".backup/"]
+    EXCLUDE_RE = re.compile("|".join(fnmatch.translate(f"{p}*") for p in patterns))
+
+
+compile_excludes()
+
+
 def should_exclude(item_name):
-    for pattern in CONFIG["exclude_from_backup"]:
-        if fnmatch.fnmatch(item_name, f"{pattern}*"):
-            return True
-    return False
+    return EXCLUDE_RE.match(item_name) is not None
+
+
+def backup_files(root=".", prefix=""):
+    # Yields (DirEntry, relative path). The relative path is built up by
+    # string concatenation, and excluded directories are not descended into.
+    with os.scandir(root) as entries:
+        for entry in entries:
+            rel_path = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not should_exclude(rel_path + "/"):
+                    yield from backup_files(entry.path, rel_path + "/")
+            elif entry.is_file() and not should_exclude(rel_path):
+                yield entry, rel_path
+
+
+def compress_file(item, rel_path):
+    with open(item, "rb") as f:
+        data = f.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    info = zipfile.ZipInfo.from_file(item, rel_path)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC = zlib.crc32(data)
+    info.file_size = len(data)
+    info.compress_size = len(compressed)
+    return info, compressed
+
+
+def bounded_map(pool, fn, items):
+    # pool.map() submits everything at once and keeps every result until it
+    # is consumed; this keeps at most BACKUP_WINDOW results in flight.
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= BACKUP_WINDOW:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, *item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def write_precompressed(zf, info, compressed):
+    # zipfile has no public API for raw deflate data; this is what
+    # ZipFile.open(..., "w") does, minus the compressor.
+    zip64 = (
+        info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        or info.compress_size > zipfile.ZIP64_LIMIT
+    )
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        info.header_offset = zf.fp.tell()
+        zf._writecheck(info)
+        zf._didModify = True
+        zf.fp.write(info.FileHeader(zip64))
+        zf.fp.write(compressed)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+
+
+def copy_raw_entry(src, dst, rel_path):
+    # Returns False when the entry is not plain deflate data (e.g. it comes
+    # from an AES zip) and has to be compressed again instead.
+    old = src.getinfo(rel_path)
+    if old.compress_type != zipfile.ZIP_DEFLATED or old.flag_bits & 0x1:
+        return False
+    src.fp.seek(old.header_offset)
+    header = struct.unpack(
+        zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader)
+    )
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local header for {rel_path}")
+    # Skip the local file name and extra field to reach the deflate stream.
+    src.fp.seek(header[10] + header[11], 1)
+    compressed = src.fp.read(old.compress_size)
+    if len(compressed) != old.compress_size:
+        raise zipfile.BadZipFile(f"Truncated entry {rel_path}")
+
+    info = zipfile.ZipInfo(rel_path, old.date_time)
+    info.external_attr = old.external_attr
+    info.compress_type = old.compress_type
+    info.CRC = old.CRC
+    info.file_size = old.file_size
+    info.compress_size = old.compress_size
+    write_precompressed(dst, info, compressed)
+    return True
+
+
+def load_manifest(backup_dir):
+    manifest_file = backup_dir / "manifest.json"
+    if not manifest_file.exists():
+        return None
+    try:
+        manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not (backup_dir / manifest.get("zip", "")).is_file():
+        return None
+    return manifest
+
+
+def previous_backup(backup_dir, zip_path):
+    # Returns (open zip, manifest files) of the last plain backup, or
+    # (None, {}) when there is nothing that can be reused.
+    manifest = load_manifest(backup_dir)
+    if not manifest or manifest["zip"] == zip_path.name:
+        return None, {}
+    try:
+        return zipfile.ZipFile(backup_dir / manifest["zip"]), manifest["files"]
+    except (OSError, zipfile.BadZipFile):
+        console.print(
+            f"[WARN] Cannot reuse {manifest['zip']}, compressing all files"
+        )
+        (backup_dir / "manifest.json").unlink(missing_ok=True)
+        return None, {}
+
+
+def write_plain_zip(path, files, previous, known):
+    # Files whose size and mtime match the last backup are copied over from
+    # its zip as-is instead of being read and deflated again. Entries that
+    # cannot be copied are compressed like any changed file.
+    # Returns (HashingFile, manifest entries, number of copied entries).
+    entries = {}
+    changed, large, unchanged = [], [], []
+    for item, rel_path in files:
+        st = item.stat()
+        entries[rel_path] = [st.st_mtime_ns, st.st_size]
+        if previous and known.get(rel_path) == entries[rel_path]:
+            unchanged.append((item, rel_path))
+        elif st.st_size > BACKUP_STREAM_SIZE:
+            large.append((item, rel_path))
+        else:
+            changed.append((item, rel_path))
+
+    reused = 0
+    with path.open("wb") as raw:
+        out = HashingFile(raw)
+        with (
+            zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf,
+            ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as pool,
+            previous or contextlib.nullcontext(),
+        ):
+            for info, compressed in bounded_map(pool, compress_file, changed):
+                write_precompressed(zf, info, compressed)
+            for item, rel_path in large:
+                zf.write(item, rel_path)
+            for item, rel_path in unchanged:
+                try:
+                    copied = copy_raw_entry(previous, zf, rel_path)
+                except (zipfile.BadZipFile, KeyError, struct.error):
+                    copied = False
+                if copied:
+                    reused += 1
+                else:
+                    write_precompressed(zf, *compress_file(item, rel_path))
+    return out, entries, reused
+
+
+def zip_is_valid(path):
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return zf.testzip() is None
+    except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError):
+        return False
+
+
+class HashingFile:
+    # Hashes the zip while it is written. Refusing seek() makes zipfile
+    # append data descriptors instead of rewriting local headers, so the
+    # bytes hashed are exactly the bytes on disk.
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def encrypt_tar_stream(stream, out, password):
+    with (
+        tarfile.open(fileobj=stream, mode="r|") as tar,
+        pyzipper.AESZipFile(
+            out, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
+        ) as zf,
+    ):
+        zf.setpassword(password.encode("utf-8"))
+        for member in tar:
+            if not member.isfile():
+                continue
+            info = zf.zipinfo_cls(member.name, time.localtime(member.mtime)[:6])
+            info.external_attr = (stat.S_IFREG | member.mode) << 16
+            info.compress_type = pyzipper.ZIP_DEFLATED
+            zf.writestr(info, tar.extractfile(member).read())
+
+
+def git_archive_backup(out, password):
+    # Only tracked files are archived, so exclude_from_backup does not apply.
+    # "git stash create" snapshots tracked changes without touching the
+    # working tree; it prints nothing when the tree is clean. Files that
+    # are only touched make it exit 1 unless the index is refreshed first.
+    run_command(["git", "update-index", "-q", "--refresh"])
+    rev = run_command(["git", "stash", "create"], capture=True) or "HEAD"
+    archive_format = "tar" if password else "zip"
+    with subprocess.Popen(
+        ["git", "archive", f"--format={archive_format}", rev], stdout=subprocess.PIPE
+    ) as proc:
+        if password:
+            try:
+                encrypt_tar_stream(proc.stdout, out, password)
+            except (tarfile.TarError, pyzipper.BadZipFile) as e:
+                # Stop git so closing the pipe cannot leave it blocked
+                proc.kill()
+                console.print(f"[ERROR] Failed to encrypt git archive: {e}")
+                return False
+        else:
+            shutil.copyfileobj(proc.stdout, out)
+    if proc.returncode != 0:
+        console.print("[ERROR] Command failed: git archive")
+        return False
+    return True
+
+
+def write_worktree_backup(backup_dir, zip_path, tmp_path, files):
+    # Returns (HashingFile, manifest entries); entries is None for AES zips.
+    password = CONFIG.get("backup_password")
+    entries = None
+    if password:
+        manifest = load_manifest(backup_dir)
+        if manifest and manifest["zip"] == zip_path.name:
+            # This AES zip replaces the one the manifest points to
+            (backup_dir / "manifest.json").unlink()
+        with tmp_path.open("wb") as raw:
+            out = HashingFile(raw)
+            # AES entries are encrypted while they are compressed, so they
+            # cannot be prepared ahead of time on worker threads.
+            with pyzipper.AESZipFile(
+                out, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
+            ) as zf:
+                zf.setpassword(password.encode("utf-8"))
+                for item, rel_path in files:
+                    zf.write(item, rel_path)
+    else:
+        previous, known = previous_backup(backup_dir, zip_path)
+        out, entries, reused = write_plain_zip(tmp_path, files, previous, known)
+        if reused and not zip_is_valid(tmp_path):
+            console.print(
+                "[WARN] Reused backup entries are corrupt, compressing all files"
+            )
+            (backup_dir / "manifest.json").unlink(missing_ok=True)
+            out, entries, _ = write_plain_zip(tmp_path, files, None, {})
+    return out, entries
+
+
+def record_backup_hash(backup_dir, timestamp, out):
+    hash_file = backup_dir / f"{timestamp}.hash"
+    hash_file.write_text(out.sha256.hexdigest())
+    console.print(f"Backup completed. Hash stored in {hash_file}")
 
 
 def backup_repo():
@@ -159,33 +500,32 @@ def backup_repo():
         console.print("[DRY-RUN] Backup skipped")
         return
 
-    if password:
-        with pyzipper.AESZipFile(
-            zip_path, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
-        ) as zf:
-            zf.setpassword(password.encode("utf-8"))
-            for item in Path(".").rglob("*"):
-                if item.is_file():
-                    rel_path = str(item.relative_to(Path(".")))
-                    if should_exclude(rel_path) or rel_path.startswith(".backup/"):
-                        continue
-                    zf.write(item, rel_path)
-    else:
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-            for item in Path(".").rglob("*"):
-                if item.is_file():
-                    rel_path = str(item.relative_to(Path(".")))
-                    if should_exclude(rel_path) or rel_path.startswith(".backup/"):
-                        continue
-                    zf.write(item, rel_path)
+    if CONFIG.get("backup_source") == "git" and Path(".git").exists():
+        with zip_path.open("wb") as raw:
+            out = HashingFile(raw)
+            ok = git_archive_backup(out, password)
+        if ok:
+            record_backup_hash(backup_dir, timestamp, out)
+        else:
+            zip_path.unlink()
+        return
 
-    sha256 = hashlib.sha256()
-    with open(zip_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha256.update(chunk)
-    hash_file = backup_dir / f"{timestamp}.hash"
-    hash_file.write_text(sha256.hexdigest())
-    console.print(f"Backup completed. Hash stored in {hash_file}")
+    files = list(backup_files())
+    # Build under a temporary name so an interrupted run never replaces or
+    # truncates an existing backup (or the one the manifest points to).
+    tmp_path = zip_path.with_name(zip_path.name + ".tmp")
+    try:
+        out, entries = write_worktree_backup(backup_dir, zip_path, tmp_path, files)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, zip_path)
+
+    record_backup_hash(backup_dir, timestamp, out)
+    if entries is not None:
+        (backup_dir / "manifest.json").write_text(
+            json.dumps({"zip": zip_path.name, "files": entries}), encoding="utf-8"
+        )
 
 
 # ----------------- Hooks -----------------
@@ -195,30 +535,30 @@ def run_hooks(phase):
         return
     console.print(style_panel("Hooks", f"Running {phase}", "cyan"))
     for cmd in hooks:
-        run_command(cmd)
+        # Hooks are user-written shell snippets and may use pipes or &&.
+        run_command(cmd, shell=True)
 
 
 # ----------------- Dependencies -----------------
 def install_dependencies():
     if Path("package-lock.json").exists():
-        run_command("npm ci")
+        run_command(["npm", "ci"])
     elif Path("package.json").exists():
-        run_command("npm install")
+        run_command(["npm", "install"])
     if Path("poetry.lock").exists():
-        run_command("poetry install")
+        run_command(["poetry", "install"])
     if Path("Pipfile.lock").exists():
-        run_command("pipenv install")
+        run_command(["pipenv", "install"])
     for req in sorted(Path(".").glob("requirements*.txt")):
-        run_command(f"pip install -r {req}")
+        run_command(["pip", "install", "-r", str(req)])
 
 
 # ----------------- Branch Choice -----------------
 def interactive_branch_choice(default_branch):
-    branches = run_command("git branch -r", capture=True)
-    if not branches:
-        return default_branch
     branch_list = [
-        b.strip().replace("origin/", "") for b in branches.splitlines() if "->" not in b
+        name.removeprefix("origin/")
+        for name, symref in remote_refs().items()
+        if not symref
     ]
     if not branch_list:
         return default_branch
@@ -236,6 +576,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     CONFIG["dry_run"] = args.dry_run
+    if args.silent:
+        console.print = plain_print
 
     console.print(style_panel("🚀 Git Repo Refresher", "Starting...", "cyan"))
     load_config()
@@ -1,7 +1,7 @@
 import os
 import subprocess
 import argparse
-import importlib.util
+import ast
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
@@ -16,21 +16,43 @@ def get_scripts(directory="."):
     return [f for f in os.listdir(directory) if f.endswith(".py")]
 
 
+def is_switch(call):
+    """
+    Nur Flags ohne Wert (store_true/store_false) lassen sich per Ja/Nein wählen.
+    """
+    for keyword in call.keywords:
+        if keyword.arg == "action" and isinstance(keyword.value, ast.Constant):
+            return keyword.value.value in ("store_true", "store_false")
+    return False
+
+
 def get_flags(script_path):
     """
-    Importiere das Skript dynamisch und lese argparse-Flags aus.
+    Lese argparse-Flags statisch aus dem Quelltext, ohne das Skript auszuführen.
     """
-    spec = importlib.util.spec_from_file_location("module.name", script_path)
-    module = importlib.util.module_from_spec(spec)  # pyright: ignore[type]
-    try:
-        spec.loader.exec_module(module)  # pyright: ignore[attribute]
-    except SystemExit:
-        # argparse ruft sys.exit() beim parse_args() auf
-        pass
-    parser = getattr(module, "parser", None)
-    if parser:
-        return [a.option_strings[0] for a in parser._actions if a.option_strings]
-    return []
+    tree = ast.parse(Path(script_path).read_text(encoding="utf-8"))
+    flags = []
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and getattr(node.func, "attr", None) == "add_argument"
+            and node.args
+            and is_switch(node)
+        ):
+            first = node.args[0]
+            if isinstance(first, ast.Constant) and str(first.value).startswith("-"):
+                flags.append((node.lineno, first.value))
+        # Skripte ohne argparse legen ihre Schalter in FLAGS = {...} ab
+        if (
+            isinstance(node, ast.Assign)
+            and any(getattr(t, "id", None) == "FLAGS" for t in node.targets)
+            and isinstance(node.value, ast.Dict)
+        ):
+            for key in node.value.keys:
+                if isinstance(key, ast.Constant):
+                    flags.append((key.lineno, key.value))
+    # ast.walk geht in Breitensuche vor, daher nach Zeile sortieren
+    return [flag for _, flag in sorted(flags)]
 
 
 # ----------------- Main -----------------
@@ -1,35 +1,96 @@
 import os
+import sys
+import json
+import hashlib
 import subprocess
 import time
-import requests
-import argparse
-from google.genai import Client
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from rich.console import Console
-from rich.panel import Panel
-from rich.progress import Progress, SpinnerColumn, TextColumn
-from rich.table import Table
 
 # ----------------- Console -----------------
 console = Console()
 
 
 def style_panel(title, text, color="cyan"):
+    from rich.panel import Panel
+
     return Panel(text, title=title, style=color, expand=True)
 
 
 # ----------------- Config & Args -----------------
-parser = argparse.ArgumentParser(description="Auto Commit & PR Creator")
-parser.add_argument("--no-pr", action="store_true", help="Skip Pull Request creation")
-parser.add_argument("--no-labels", action="store_true", help="Skip PR labeling")
-parser.add_argument(
-    "--no-push", action="store_true", help="Do not push branch to remote"
+# Larger diffs are sent as --stat plus their first lines only
+MAX_PROMPT_BYTES = 32 * 1024
+DIFF_CONTEXT_LINES = 200
+
+# Only the prompt leaves these out; they are still committed
+DIFF_PATHSPEC = [
+    "--",
+    ".",
+    ":(exclude)*.lock",
+    ":(exclude)package-lock.json",
+    ":(exclude)dist/*",
+    ":(exclude)build/*",
+]
+
+# Boolean switches and their help texts; run.py reads this dict too
+FLAGS = {
+    "--no-pr": "Skip Pull Request creation",
+    "--no-labels": "Skip PR labeling",
+    "--no-push": "Do not push branch to remote",
+    "--silent": "Minimal output (no spinners)",
+    "--dry-run": "Simulate without executing",
+    "--no-cache": "Always ask Gemini, ignoring cached results",
+}
+SHORT_USAGE = (
+    "usage: upload.py [-h] "
+    + " ".join(f"[{flag}]" for flag in FLAGS)
+    + " [--max-diff-bytes N]"
 )
-parser.add_argument(
-    "--silent", action="store_true", help="Minimal output (no spinners)"
+USAGE = "\n".join(
+    [
+        SHORT_USAGE,
+        "",
+        "Auto Commit & PR Creator",
+        "",
+        *(f"  {flag:<20} {text}" for flag, text in FLAGS.items()),
+        "  --max-diff-bytes N   Summarize diffs larger than this before sending "
+        "them to Gemini",
+    ]
 )
-parser.add_argument("--dry-run", action="store_true", help="Simulate without executing")
-args = parser.parse_args()
+
+
+def usage_error(message):
+    # Same output and exit status as argparse's parser.error()
+    print(f"{SHORT_USAGE}\nupload.py: error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def parse_args(argv):
+    # argparse costs more to import and build than these few flags need
+    values = {flag[2:].replace("-", "_"): False for flag in FLAGS}
+    values["max_diff_bytes"] = MAX_PROMPT_BYTES
+    remaining = iter(argv)
+    for arg in remaining:
+        if arg in ("-h", "--help"):
+            print(USAGE)
+            sys.exit(0)
+        elif arg in FLAGS:
+            values[arg[2:].replace("-", "_")] = True
+        elif arg == "--max-diff-bytes" or arg.startswith("--max-diff-bytes="):
+            value = arg.partition("=")[2] or next(remaining, "")
+            if not value.isdigit():
+                usage_error("--max-diff-bytes expects a number")
+            values["max_diff_bytes"] = int(value)
+        else:
+            usage_error(f"unrecognized arguments: {arg}")
+    return SimpleNamespace(**values)
+
+
+args = parse_args(sys.argv[1:])
 
 # Load env
 load_dotenv()
@@ -40,28 +101,144 @@ if not api_key:
 
 base_branch = "main"
 
+CHANGE_TYPES = ["feature", "fix", "docs", "refactor", "test", "chore"]
+
+# Kept byte-identical across runs so Gemini's implicit prefix cache can hit;
+# the diff itself is the only user content.
+SYSTEM_PROMPT = f"""
+Analyze the code diff you are given and return a JSON object with:
+- labels: all applicable change types ({", ".join(CHANGE_TYPES)})
+- commit_message: a concise commit message
+- pr_title: a short, descriptive Pull Request title
+""".strip()
+
+# Gemini results per diff, so re-running on the same staged changes is free
+CACHE_DIR = Path.home() / ".cache" / "notemanager" / "labels"
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
 
 # ----------------- Helpers -----------------
-def run_verbose(cmd, description="", capture_output=False):
+def run_verbose(
+    cmd, description="", capture_output=False, input=None, replace_process=False
+):
     if args.dry_run:
         console.print(f"[DRY-RUN] {description}: {' '.join(cmd)}")
         return None
-    console.print(style_panel("Running", " ".join(cmd) + f"\n{description}", "magenta"))
+    if not args.silent:
+        console.print(
+            style_panel("Running", " ".join(cmd) + f"\n{description}", "magenta")
+        )
     if capture_output:
         result = subprocess.run(cmd, text=True, capture_output=True)
         return result
-    else:
-        subprocess.run(cmd, check=True)
+    if args.silent:
+        # Drop git's chatter; keep stderr only to explain a failure
+        result = subprocess.run(
+            cmd, input=input, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        if result.returncode != 0:
+            console.print(result.stderr.decode(errors="replace").strip())
+            result.check_returncode()
         return None
+    if replace_process:
+        # Nothing runs after cmd: exec it instead of forking, so it inherits
+        # stdio and its exit status becomes ours
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp(cmd[0], cmd)
+    subprocess.run(cmd, input=input, check=True)
+    return None
 
 
-def gemini_generate(prompt, task_name):
-    if args.silent:
+def unstaged_paths():
+    # Returns (has_changes, paths) from one `git status` call. paths are the
+    # entries with worktree changes, as root-relative literal pathspecs.
+    output = subprocess.run(
+        ["git", "status", "--porcelain=v1", "-z", "--", "."],
+        check=True,
+        capture_output=True,
+    ).stdout
+    entries = iter(output.split(b"\0"))
+    has_changes = False
+    paths = []
+    for entry in entries:
+        if not entry:
+            continue
+        has_changes = True
+        index_status, worktree_status = entry[0:1], entry[1:2]
+        if worktree_status != b" ":
+            paths.append(b":(top,literal)" + entry[3:])
+        if index_status in (b"R", b"C"):
+            next(entries)  # source path of a staged rename or copy
+    return has_changes, paths
+
+
+def create_client():
+    from google.genai import Client
+
+    return Client(api_key=api_key)
+
+
+def read_staged_diff():
+    # Returns (diff, truncated). At most --max-diff-bytes are read from
+    # git's pipe, so a huge diff never sits in memory as a whole.
+    if args.dry_run:
+        return "DRY RUN DIFF CONTENT", False
+    # Non-UTF-8 file contents must not abort the run. Deleted files are
+    # shown by name only, without their removed lines.
+    with subprocess.Popen(
+        ["git", "diff", "--staged", "--no-ext-diff", "--irreversible-delete"]
+        + DIFF_PATHSPEC,
+        stdout=subprocess.PIPE,
+    ) as proc:
+        diff = proc.stdout.read(args.max_diff_bytes + 1)
+        truncated = len(diff) > args.max_diff_bytes
+        if truncated:
+            proc.kill()
+    if not truncated and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return diff[: args.max_diff_bytes].decode("utf-8", errors="replace"), truncated
+
+
+def load_cached_metadata(cache_file):
+    try:
+        if time.time() - cache_file.stat().st_mtime > CACHE_MAX_AGE:
+            return None
+        return json.loads(cache_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def metadata_config():
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_PROMPT,
+        response_mime_type="application/json",
+        response_schema=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "labels": types.Schema(
+                    type=types.Type.ARRAY,
+                    items=types.Schema(type=types.Type.STRING, enum=CHANGE_TYPES),
+                ),
+                "commit_message": types.Schema(type=types.Type.STRING),
+                "pr_title": types.Schema(type=types.Type.STRING),
+            },
+            required=["labels", "commit_message", "pr_title"],
+        ),
+    )
+
+
+def gemini_generate(prompt, task_name, config=None):
+    if args.silent or not console.is_terminal:
         response = client.models.generate_content(
-            model="gemini-2.5-flash", contents=prompt
+            model="gemini-2.5-flash", contents=prompt, config=config
         )
         return response.text.strip()
 
+    from rich.progress import Progress, SpinnerColumn, TextColumn
+
     console.print(f"[bold blue]{task_name} via Gemini...[/bold blue]")
     with Progress(
         SpinnerColumn(),
@@ -72,59 +249,127 @@ def gemini_generate(prompt, task_name):
         task = progress.add_task(f"{task_name} in progress", start=False)
         progress.start_task(task)
         response = client.models.generate_content(
-            model="gemini-2.5-flash", contents=prompt
+            model="gemini-2.5-flash", contents=prompt, config=config
         )
     return response.text.strip()
 
 
+def summarize_diff(diff, truncated):
+    if not diff.strip() and not args.dry_run:
+        # Only excluded paths (lockfiles, build output) changed: name them
+        # instead of sending Gemini an empty prompt
+        return subprocess.run(
+            ["git", "diff", "--staged", "--name-status"],
+            capture_output=True,
+            encoding="utf-8",
+            errors="replace",
+        ).stdout
+    if not truncated:
+        return diff
+    stat = subprocess.run(
+        ["git", "diff", "--staged", "--stat", *DIFF_PATHSPEC],
+        capture_output=True,
+        encoding="utf-8",
+        errors="replace",
+    ).stdout
+    head = "\n".join(diff.splitlines()[:DIFF_CONTEXT_LINES])
+    return f"{stat}\n\n{head}\n..."
+
+
+def warm_up_github():
+    try:
+        github.head("https://api.github.com", timeout=10)
+    except requests.RequestException:
+        pass
+
+
 # ----------------- Main -----------------
 console.print(style_panel("🚀 Auto Commit & PR Script", "Starting...", "cyan"))
 
 # Stage all changes
-run_verbose(["git", "add", "."], "Staging all changes")
+has_changes, paths = unstaged_paths()
+if not has_changes:
+    console.print("[INFO] Nothing to commit")
+    sys.exit(0)
+if paths:
+    run_verbose(
+        ["git", "add", "--pathspec-from-file=-", "--pathspec-file-nul"],
+        f"Staging {len(paths)} changed paths",
+        input=b"\0".join(paths),
+    )
 
-# Save staged diff
-diff_file = "changes.diff"
-if not args.dry_run:
-    with open(diff_file, "w") as f:
-        subprocess.run(["git", "diff", "--staged"], stdout=f, check=True)
-    with open(diff_file, "r") as f:
-        diff_content = f.read()
+# Read staged diff while the Gemini client is set up on a worker thread
+with ThreadPoolExecutor(max_workers=1) as pool:
+    client_future = pool.submit(create_client)
+    diff_content, diff_truncated = read_staged_diff()
+    if diff_truncated:
+        console.print(
+            f"[dim]Diff exceeds {args.max_diff_bytes} bytes, summarizing[/dim]"
+        )
+    else:
+        console.print(f"[dim]Diff length: {len(diff_content)} characters[/dim]")
+    prompt_diff = summarize_diff(diff_content, diff_truncated)
+    client = client_future.result()
+
+# Open the GitHub connection while Gemini is busy
+github_token = os.getenv("GITHUB_TOKEN")
+github_warmup = None
+if not args.no_pr:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    github = requests.Session()
+    github.headers.update(
+        {"Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"}
+    )
+    github.mount(
+        "https://",
+        HTTPAdapter(
+            max_retries=Retry(
+                total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+            )
+        ),
+    )
+    if github_token:
+        github.headers.update({"Authorization": f"token {github_token}"})
+        if not args.dry_run:
+            github_warmup = threading.Thread(target=warm_up_github, daemon=True)
+            github_warmup.start()
+
+# Generate labels, commit message and PR title in one request
+cache_file = CACHE_DIR / f"{hashlib.sha256(prompt_diff.encode()).hexdigest()}.json"
+metadata = None if args.no_cache else load_cached_metadata(cache_file)
+if metadata is not None:
+    console.print("[dim]Using cached commit metadata[/dim]")
+elif not prompt_diff.strip():
+    console.print("[WARN] Empty staged diff, using default commit metadata")
+    metadata = {}
 else:
-    diff_content = "DRY RUN DIFF CONTENT"
-console.print(f"[dim]Diff length: {len(diff_content)} characters[/dim]")
-
-# Initialize Gemini client
-client = Client(api_key=api_key)
-
-# Detect commit type
-type_prompt = f"""
-Analyze the following code diff and determine all applicable change types.
-Possible labels: feature, fix, docs, refactor, test, chore.
-YOU MUST RETURN THE LABELS, AND ONLY THE LABELS, IN A COMMA SEPERATED LIST.
-(e.g. 'feature, docs')
-
-Diff:
-{diff_content}
-"""
-labels_text = gemini_generate(type_prompt, "Detecting change types")
-labels = [label.strip().lower() for label in labels_text.split(",") if label.strip()]
+    metadata_text = gemini_generate(
+        prompt_diff, "Generating commit metadata", config=metadata_config()
+    )
+    try:
+        metadata = json.loads(metadata_text)
+    except json.JSONDecodeError:
+        metadata = {}
+    if metadata and not args.dry_run and not args.no_cache:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps(metadata), encoding="utf-8")
+
+labels = [
+    label.strip().lower() for label in metadata.get("labels", []) if label.strip()
+]
 if not labels:
     labels = ["feature"]
-
-# Generate commit message
-commit_prompt = f"Generate a concise commit message for this code diff.\n{diff_content}"
-commit_message = gemini_generate(commit_prompt, "Commit message generation")
-if not commit_message:
-    commit_message = "Auto commit with generated message"
-
-# Generate PR title
-pr_title_prompt = (
-    f"Generate a short, descriptive Pull Request title for this diff.\n{diff_content}"
+commit_message = (
+    metadata.get("commit_message", "").strip() or "Auto commit with generated message"
 )
-pr_title = gemini_generate(pr_title_prompt, "PR title generation") or commit_message
+pr_title = metadata.get("pr_title", "").strip() or commit_message
 
 # Show summary
+from rich.table import Table
+
 summary = Table(title="Commit Summary", header_style="bold cyan")
 summary.add_column("Labels", style="yellow")
 summary.add_column("Commit Message", style="green")
@@ -138,21 +383,26 @@ run_verbose(["git", "checkout", "-b", branch_name], f"Creating branch {branch_na
 
 # Commit
 run_verbose(["git", "commit", "-m", commit_message], "Committing changes")
+if not args.dry_run:
+    cache_file.unlink(missing_ok=True)
 
 # Push
 if not args.no_push:
-    run_verbose(["git", "push", "origin", branch_name], "Pushing branch to remote")
+    # With --no-pr the push is the last step, so git may replace this process
+    run_verbose(
+        ["git", "push", "origin", branch_name],
+        "Pushing branch to remote" + (" (skipping PR, --no-pr)" if args.no_pr else ""),
+        replace_process=args.no_pr,
+    )
 else:
     console.print("[INFO] Skipping push (--no-push)")
 
 # Create PR
 if not args.no_pr:
     repo = os.getenv("GITHUB_REPO", "ProjectSaveGH/NoteManager")
-    token = os.getenv("GITHUB_TOKEN")
-    if not token:
+    if not github_token:
         raise ValueError("GITHUB_TOKEN not set")
 
-    headers = {"Authorization": f"token {token}"}
     url_create_pr = f"https://api.github.com/repos/{repo}/pulls"
     payload = {
         "title": pr_title,
@@ -161,7 +411,9 @@ if not args.no_pr:
         "body": f"Commit Message:\n{commit_message}\n\nGenerated automatically.",
     }
     if not args.dry_run:
-        response = requests.post(url_create_pr, json=payload, headers=headers)
+        if github_warmup:
+            github_warmup.join()
+        response = github.post(url_create_pr, json=payload)
         if response.status_code == 201:
             pr_number = response.json()["number"]
             console.print(
@@ -172,18 +424,13 @@ if not args.no_pr:
                     f"https://api.github.com/repos/{repo}/issues/{pr_number}/labels"
                 )
                 payload_labels = {"labels": labels}
-                resp_labels = requests.post(
-                    url_labels, json=payload_labels, headers=headers
-                )
+                resp_labels = github.post(url_labels, json=payload_labels)
                 if resp_labels.status_code == 200:
                     console.print(f"✅ Labels added: {', '.join(labels)}")
                 else:
                     console.print(f"❌ Failed to add labels: {resp_labels.text}")
     else:
         console.print("[DRY-RUN] PR creation skipped")
+    github.close()
 else:
     console.print("[INFO] Skipping PR (--no-pr)")
-
-# Cleanup
-if os.path.exists(diff_file):
-    os.remove(diff_file)